@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+
+"""cache.py
+
+In-instance caching helpers.
+
+LRUCache is a bounded per-instance cache with per-entry expiry. TwoTierCache
+puts a short-lived LRUCache in front of memcache for small, hot values, so
+most reads never leave the instance; its memcache keys carry a version
+number that invalidate() bumps to drop every entry on every instance.
+FlushedCounters counts locally and folds the counts into memcache at most
+once per interval, so hot paths can be counted without an RPC per event.
+"""
+
+import collections
+import threading
+import time
+
+from google.appengine.api import memcache
+
+CACHE_STATS = ('local_hits', 'memcache_hits', 'misses')
+# stored locally for keys memcache does not have, so misses are cached too
+_ABSENT = object()
+
+
+class LRUCache(object):
+    """Small thread-safe, size-bounded in-memory cache with per-entry expiry."""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return the cached value, or None if absent or expired."""
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at <= time.time():
+                return None
+            # re-insert to mark as most recently used
+            self._data[key] = entry
+            return value
+
+    def set(self, key, value, expires_at):
+        """Store value until the absolute time expires_at, evicting the oldest entry if full."""
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (value, expires_at)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class FlushedCounters(object):
+    """Named counters kept in instance memory and flushed to memcache periodically."""
+
+    def __init__(self, key_prefix, flush_interval=30):
+        self.key_prefix = key_prefix
+        self.flush_interval = flush_interval
+        self._pending = collections.Counter()
+        self._lock = threading.Lock()
+        self._last_flush = time.time()
+
+    def incr(self, name, delta=1):
+        with self._lock:
+            self._pending[name] += delta
+            if time.time() - self._last_flush < self.flush_interval:
+                return
+            pending, self._pending = self._pending, collections.Counter()
+            self._last_flush = time.time()
+        self._flush(pending)
+
+    def _flush(self, pending):
+        if pending:
+            memcache.offset_multi(dict(pending), key_prefix=self.key_prefix, initial_value=0)
+
+    def flush(self):
+        """Push this instance's unflushed counts to memcache now."""
+        with self._lock:
+            pending, self._pending = self._pending, collections.Counter()
+            self._last_flush = time.time()
+        self._flush(pending)
+
+    def totals(self, names):
+        """Counts across all instances, as of each instance's last flush."""
+        counts = memcache.get_multi(names, key_prefix=self.key_prefix)
+        return dict((name, counts.get(name, 0)) for name in names)
+
+
+class TwoTierCache(object):
+    """Per-instance LRU with a short TTL in front of versioned memcache keys."""
+
+    def __init__(self, namespace, local_ttl=60, max_size=100):
+        self.namespace = namespace
+        self.local_ttl = local_ttl
+        self._local = LRUCache(max_size)
+        self._version_key = '%s:version' % namespace
+        self._stats = FlushedCounters('CACHE_STATS_%s:' % namespace)
+
+    def _count(self, stat):
+        self._stats.incr(stat)
+
+    def _version(self):
+        """Current key version; cached locally like any other value."""
+        version = self._local.get(self._version_key)
+        if version is None:
+            version = memcache.get(self._version_key)
+            if version is None:
+                # seeded with the time, so a version evicted from memcache
+                # never falls back to a number whose keys may still be cached
+                memcache.add(self._version_key, int(time.time()))
+                version = memcache.get(self._version_key) or 0
+            self._local.set(self._version_key, version, time.time() + self.local_ttl)
+        return version
+
+    def _memcacheKey(self, key):
+        return '%s:v%d:%s' % (self.namespace, self._version(), key)
+
+    def get(self, key):
+        """Return the cached value, or None if neither tier has it."""
+        value = self._local.get(key)
+        if value is not None:
+            self._count('local_hits')
+            return None if value is _ABSENT else value
+
+        value = memcache.get(self._memcacheKey(key))
+        self._count('memcache_hits' if value is not None else 'misses')
+        self._local.set(key, _ABSENT if value is None else value,
+                        time.time() + self.local_ttl)
+        return value
+
+    def set(self, key, value, time_to_live=0):
+        """Store value in both tiers; other instances see it within local_ttl."""
+        memcache.set(self._memcacheKey(key), value, time=time_to_live)
+        self._local.set(key, value, time.time() + self.local_ttl)
+
+    def delete(self, key):
+        memcache.delete(self._memcacheKey(key))
+        self._local.set(key, _ABSENT, time.time() + self.local_ttl)
+
+    def invalidate(self):
+        """Drop every key in this cache, on every instance, by bumping the version."""
+        memcache.incr(self._version_key, initial_value=0)
+        self._local.clear()
+
+    def stats(self):
+        """Hit/miss counters summed over all instances."""
+        return self._stats.totals(CACHE_STATS)
@@ -13,18 +13,23 @@ created by wesc on 2014 apr 21
 __author__ = 'wesc+api@google.com (Wesley Chun)'
 
 
-from datetime import datetime
-import json, os, time, endpoints
+from datetime import datetime, timedelta
+import endpoints
 from protorpc import messages, message_types, remote
 
-from google.appengine.api import urlfetch, memcache, taskqueue
+from google.appengine.api import memcache
 from google.appengine.ext import ndb
+from google.appengine.datastore.datastore_query import Cursor
 
 from models import Profile, ProfileMiniForm, ProfileForm, TeeShirtSize, Conference, ConferenceForm
 from models import ConferenceForms, ConferenceQueryForm, ConferenceQueryForms, BooleanMessage
 from models import ConflictException, StringMessage, Session, SessionForm, SessionForms
+from models import SeatAvailabilityForm, SeatAvailabilityForms, PageBundleForm
+from models import Tombstone, ChangesForm, ChangesExpiredException
 
-from settings import WEB_CLIENT_ID
+from cache import TwoTierCache
+from ratelimit import rateLimited
+from settings import WEB_CLIENT_ID, TOMBSTONE_RETENTION_DAYS
 from utils import getUserId
 
 DEFAULTS = {
@@ -55,6 +60,27 @@ CONF_GET_REQUEST = endpoints.ResourceContainer(
     websafeConferenceKey=messages.StringField(1),
 )
 
+SEATS_GET_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    websafeConferenceKeys=messages.StringField(1, repeated=True),
+)
+
+PAGE_BUNDLE_REQUEST = endpoints.ResourceContainer(
+    ConferenceQueryForms,
+    websafeConferenceKey=messages.StringField(2),
+    includeConferences=messages.BooleanField(3),
+)
+
+CHANGES_GET_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    since=messages.StringField(1),
+    until=messages.StringField(2),
+    conferenceCursor=messages.StringField(3),
+    sessionCursor=messages.StringField(4),
+    deletedCursor=messages.StringField(5),
+    limit=messages.IntegerField(6),
+)
+
 SESSION_GET_REQUEST = endpoints.ResourceContainer(
     message_types.VoidMessage,
     websafeConferenceKey=messages.StringField(1),
@@ -91,6 +117,11 @@ SESSION_WISHLIST_POST_REQUEST = endpoints.ResourceContainer(
     websafeConferenceKey=messages.StringField(1),
 )
 
+SESSION_WISHLIST_BATCH_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    websafeSessionKeys=messages.StringField(1, repeated=True),
+)
+
 WISHLIST_GET_REQUEST_BY_TYPE = endpoints.ResourceContainer(
     typeOfSession=messages.StringField(1)
 )
@@ -102,8 +133,27 @@ SESSION_SPEAKER_REQUEST = endpoints.ResourceContainer(
 EMAIL_SCOPE = endpoints.EMAIL_SCOPE
 API_EXPLORER_CLIENT_ID = endpoints.API_EXPLORER_CLIENT_ID
 MEMCACHE_ANNOUNCEMENTS_KEY = "RECENT_ANNOUNCEMENTS"
+# the announcement changes at most hourly, so instances may serve it from memory
+HOT_CACHE = TwoTierCache('hot', local_ttl=60)
 ANNOUNCEMENT_TPL = ('Last chance to attend! The following conferences '
                     'are nearly sold out: %s')
+MEMCACHE_SEATS_PREFIX = "SEATS_"
+# seat counts are polled heavily during a registration rush; keep them short lived
+SEATS_CACHE_TTL = 5
+SEATS_MAX_KEYS = 100
+WISHLIST_BATCH_MAX_KEYS = 50
+# keeps the Profile entity far below the datastore's size limit
+WISHLIST_MAX_SIZE = 500
+# conferences on the first page of the default listing, warmed on instance start
+WARMUP_CONFERENCES = 20
+CHANGES_DEFAULT_LIMIT = 100
+CHANGES_MAX_LIMIT = 500
+# cursor value marking a kind whose changes have all been returned
+CHANGES_DONE = 'done'
+WATERMARK_FORMAT = "%Y-%m-%dT%H:%M:%S.%f"
+# modified is stamped at put time and the index catches up later, so the
+# default upper bound stays this far behind now; nothing lands behind it
+CHANGES_SAFETY_LAG = timedelta(seconds=10)
 SESSION_DEFAULTS = {
     "highlights": "Coming Soon",
     "duration": 60,
@@ -261,6 +311,8 @@ class ConferenceApi(remote.Service):
 
         # create Conference & return (modified) ConferenceForm
         Conference(**data).put()
+        # only needed when creating conferences; keep it off the cold-start path
+        from google.appengine.api import taskqueue
         taskqueue.add(params={'email': user.email(),
                       'conferenceInfo': repr(request)},
                       url='/tasks/send_confirmation_email')
@@ -279,6 +331,7 @@ class ConferenceApi(remote.Service):
                       path='queryConferences',
                       http_method='POST',
                       name='queryConferences')
+    @rateLimited('queryConferences')
     def queryConferences(self, request):
         """Query for conferences."""
         conferences = self._getQuery(request)
@@ -425,7 +478,10 @@ class ConferenceApi(remote.Service):
                       name='registerForConference')
     def registerForConference(self, request):
         """Register user for selected conference."""
-        return self._conferenceRegistration(request)
+        retval = self._conferenceRegistration(request)
+        # the seat count changed, drop the cached value once the transaction committed
+        memcache.delete(MEMCACHE_SEATS_PREFIX + request.websafeConferenceKey)
+        return retval
 
     @endpoints.method(message_types.VoidMessage, ConferenceForms,
                       path='conferences/attending',
@@ -457,6 +513,39 @@ class ConferenceApi(remote.Service):
         return ConferenceForms(items=[self._copyConferenceToForm(conf,
                                                                  names[conf.organizerUserId]) for conf in conferences])
 
+    @endpoints.method(SEATS_GET_REQUEST, SeatAvailabilityForms,
+                      path='conferences/seats',
+                      http_method='GET', name='getSeatAvailability')
+    def getSeatAvailability(self, request):
+        """Return live seat counts for many conferences in one call."""
+        wscks = list(set(request.websafeConferenceKeys))
+        if len(wscks) > SEATS_MAX_KEYS:
+            raise endpoints.BadRequestException(
+                'At most %d conference keys may be requested at once.' % SEATS_MAX_KEYS)
+
+        # serve what we can from memcache, fetch the rest with one get_multi
+        seats = memcache.get_multi(wscks, key_prefix=MEMCACHE_SEATS_PREFIX)
+        missing = [wsck for wsck in wscks if wsck not in seats]
+        if missing:
+            try:
+                conf_keys = [ndb.Key(urlsafe=wsck) for wsck in missing]
+            except Exception:
+                raise endpoints.BadRequestException('Invalid conference key.')
+            fetched = {}
+            for wsck, conf in zip(missing, ndb.get_multi(conf_keys)):
+                # websafe keys of other kinds are treated like unknown conferences
+                if conf and conf.key.kind() == 'Conference':
+                    fetched[wsck] = (conf.seatsAvailable, conf.maxAttendees)
+            memcache.set_multi(fetched, time=SEATS_CACHE_TTL, key_prefix=MEMCACHE_SEATS_PREFIX)
+            seats.update(fetched)
+
+        # unknown conferences are simply left out of the response
+        return SeatAvailabilityForms(items=[
+            SeatAvailabilityForm(websafeKey=wsck,
+                                 seatsAvailable=seats[wsck][0],
+                                 maxAttendees=seats[wsck][1])
+            for wsck in request.websafeConferenceKeys if wsck in seats])
+
 
 # - - - Session objects - - - - - - - - - - - - - - - - -
 
@@ -502,14 +591,19 @@ class ConferenceApi(remote.Service):
     def _copySessionToForm(self, session):
         """ Copies the fields from session to sessionForm """
         sessForm = SessionForm()
-        for field in session.all_fields():
-            if hasattr(sessForm, field.name):
-                if field.name.endswith('Date'):
-                    setattr(sessForm, field.name, str(getattr(session, field.name)))
-                else:
-                    setattr(sessForm, field.name, getattr(session, field.name))
-            elif field.name == "websafeKey":
+        for field in sessForm.all_fields():
+            if field.name == "websafeKey":
                 setattr(sessForm, field.name, session.key.urlsafe())
+            elif hasattr(session, field.name):
+                value = getattr(session, field.name)
+                # convert date and time to strings; just copy others
+                if field.name in ('date', 'startTime'):
+                    setattr(sessForm, field.name, str(value) if value else None)
+                elif field.name == 'duration' and not isinstance(value, (int, long)):
+                    # a legacy duration the migration could not parse
+                    continue
+                else:
+                    setattr(sessForm, field.name, value)
         sessForm.check_initialized()
         return sessForm
 
@@ -549,6 +643,7 @@ class ConferenceApi(remote.Service):
                       path='sessions/speaker',
                       http_method='POST',
                       name='getConferenceSessionsBySpeaker')
+    @rateLimited('getConferenceSessionsBySpeaker')
     def getConferenceSessionsBySpeaker(self, request):
         """ Given a speaker, return all sessions given by this particular speaker, across all conferences """
         sessions = Session.query(Session.speaker == request.speaker)
@@ -578,32 +673,88 @@ class ConferenceApi(remote.Service):
                       name="addSessionToWishList")
     def addSessionToWishlist(self, request):
         """Adds the session to the users's list of sessions based on interest."""
-        retval = None
-        prof = self._getProfileFromUser()
+        if not endpoints.get_current_user():
+            raise endpoints.UnauthorizedException('Authorization required')
         wsck = request.websafeConferenceKey
-        session = ndb.Key(urlsafe=wsck).get()
+        self._checkSessionsExist([wsck])
+        # same transactional profile write as the batch endpoint; the session entity is left untouched
+        if not self._wishlistUpdate([wsck]).data:
+            raise ConflictException('You have already added this to your wishlist.')
+        return BooleanMessage(data=True)
 
-        if not session:
-            raise endpoints.NotFoundException('No Session found with key: %s' % wsck)
+    def _wishlistBatchKeys(self, request):
+        """Return the requested session keys, deduplicated; bail if unauthed or too many."""
+        if not endpoints.get_current_user():
+            raise endpoints.UnauthorizedException('Authorization required')
+        wssks = list(set(request.websafeSessionKeys))
+        if len(wssks) > WISHLIST_BATCH_MAX_KEYS:
+            raise endpoints.BadRequestException(
+                'At most %d session keys may be sent at once.' % WISHLIST_BATCH_MAX_KEYS)
+        return wssks
+
+    def _checkSessionsExist(self, wssks):
+        """Fetch all given sessions with one get_multi; bail if any is missing."""
+        try:
+            session_keys = [ndb.Key(urlsafe=wssk) for wssk in wssks]
+        except Exception:
+            raise endpoints.BadRequestException('Invalid session key.')
+        missing = [wssk for wssk, session in zip(wssks, ndb.get_multi(session_keys))
+                   if not session or session.key.kind() != 'Session']
+        if missing:
+            raise endpoints.NotFoundException(
+                'No Session found with key: %s' % ', '.join(missing))
 
-        if wsck in prof.wishlistKeys:
-            raise ConflictException('You have already added this to your wishlist.')
+    @ndb.transactional
+    def _wishlistUpdate(self, wssks, add=True):
+        """Add or remove sessions from the user's wishlist in a single profile write."""
+        prof = self._getProfileFromUser()
+        # one set per update keeps a batch linear in wishlist + request size
+        wishlist = set(prof.wishlistKeys)
+
+        if add:
+            new_keys = [wssk for wssk in wssks if wssk not in wishlist]
+            if len(prof.wishlistKeys) + len(new_keys) > WISHLIST_MAX_SIZE:
+                raise endpoints.BadRequestException(
+                    'A wishlist holds at most %d sessions.' % WISHLIST_MAX_SIZE)
+            prof.wishlistKeys.extend(new_keys)
+            changed = bool(new_keys)
         else:
-            prof.wishlistKeys.append(wsck)
-            retval = True
+            drop = wishlist.intersection(wssks)
+            prof.wishlistKeys = [wssk for wssk in prof.wishlistKeys if wssk not in drop]
+            changed = bool(drop)
 
-        prof.put()
-        session.put()
-        return BooleanMessage(data=retval)
+        if changed:
+            prof.put()
+        return BooleanMessage(data=changed)
+
+    @endpoints.method(SESSION_WISHLIST_BATCH_REQUEST, BooleanMessage,
+                      path='wishlist/add',
+                      http_method='POST',
+                      name='addSessionsToWishlist')
+    def addSessionsToWishlist(self, request):
+        """Add many sessions to the user's wishlist; true if the wishlist changed."""
+        wssks = self._wishlistBatchKeys(request)
+        # session lookups span many entity groups, so check them outside the transaction
+        self._checkSessionsExist(wssks)
+        return self._wishlistUpdate(wssks)
+
+    @endpoints.method(SESSION_WISHLIST_BATCH_REQUEST, BooleanMessage,
+                      path='wishlist/remove',
+                      http_method='POST',
+                      name='removeSessionsFromWishlist')
+    def removeSessionsFromWishlist(self, request):
+        """Remove many sessions from the user's wishlist; true if the wishlist changed."""
+        return self._wishlistUpdate(self._wishlistBatchKeys(request), add=False)
 
     @endpoints.method(message_types.VoidMessage, SessionForms,
                       path='wishlist',
                       http_method='GET',
                       name='getSessionsInWishlist')
+    @rateLimited('getSessionsInWishlist')
     def getSessionsInWishlist(self, request):
         """Query the sessions in a users wishlist"""
         prof = self._getProfileFromUser()
-        session_keys = [ndb.Key(urlsafe=wsck) for wsck in prof.wishlistkeys]
+        session_keys = [ndb.Key(urlsafe=wsck) for wsck in prof.wishlistKeys]
         wish_list_sessions = ndb.get_multi(session_keys)
         return SessionForms(
             items=[self._copySessionToForm(x) for x in wish_list_sessions]
@@ -614,6 +765,7 @@ class ConferenceApi(remote.Service):
                       path="withlist/type",
                       http_method="GET",
                       name="getSessionsInWishlistByType")
+    @rateLimited('getSessionsInWishlistByType')
     def getSessionsInWishlistByType(self, request):
         """Return a wishlist filtered by type for the user"""
         prof = self._getProfileFromUser()
@@ -628,6 +780,7 @@ class ConferenceApi(remote.Service):
                       path="wishlist/speaker",
                       http_method="GET",
                       name="getSessionInWishlistBySpeaker")
+    @rateLimited('getSessionsInWishlistBySpeaker')
     def getSessionsInWishlistBySpeaker(self, request):
         """Return users wishlist filtered by speaker"""
         prof = self._getProfileFromUser()
@@ -659,7 +812,7 @@ class ConferenceApi(remote.Service):
             #     'are nearly sold out:',
             #     ', '.join(conf.name for conf in confs))
             print "The announcement has been created. Here: ", announcement
-            memcache.set(MEMCACHE_ANNOUNCEMENTS_KEY, announcement)
+            HOT_CACHE.set(MEMCACHE_ANNOUNCEMENTS_KEY, announcement)
             print "The announcement has been set."
         else:
             print "We are going to delete the announcement from memcache"
@@ -667,21 +820,137 @@ class ConferenceApi(remote.Service):
             # delete the memcache announcements entry
             announcement = ""
             print "no announcement: ", announcement
-            memcache.delete(MEMCACHE_ANNOUNCEMENTS_KEY)
+            HOT_CACHE.delete(MEMCACHE_ANNOUNCEMENTS_KEY)
             print "The announcement has been deleted from memcache."
 
         return announcement
 
+    @staticmethod
+    def _primeCaches():
+        """Fill the hot caches for a fresh instance; used by the warmup handler."""
+        if HOT_CACHE.get(MEMCACHE_ANNOUNCEMENTS_KEY) is None:
+            ConferenceApi._cacheAnnouncement()
+        # the default listing is ordered by name; get_multi puts those
+        # conferences in ndb's memcache for the detail and seat lookups
+        top = Conference.query().order(Conference.name).fetch(WARMUP_CONFERENCES, keys_only=True)
+        ndb.get_multi(top)
+
     @endpoints.method(message_types.VoidMessage, StringMessage,
                       path='conference/announcement/get',
                       http_method='GET',
                       name='getAnnouncement')
     def getAnnouncement(self, request):
-        """Return Announcement from memcache."""
-        announcement = memcache.get(MEMCACHE_ANNOUNCEMENTS_KEY)
+        """Return Announcement from the instance or memcache."""
+        announcement = HOT_CACHE.get(MEMCACHE_ANNOUNCEMENTS_KEY)
         if not announcement:
             announcement = ""
         return StringMessage(data=announcement)
 
+# - - - Page bundle - - - - - - - - - - - - - - - - - - - -
+    @endpoints.method(PAGE_BUNDLE_REQUEST, PageBundleForm,
+                      path='pageBundle',
+                      http_method='POST',
+                      name='getPageBundle')
+    # only the conference query is expensive; detail bundles are key gets
+    @rateLimited('getPageBundle', when=lambda request: request.includeConferences)
+    def getPageBundle(self, request):
+        """Return conference or query page, announcement and, with a
+        conference, the profile and registration status in one response;
+        the lookups run concurrently.
+        """
+        bundle = PageBundleForm()
+
+        # kick off every independent lookup before waiting on any of them
+        conf_fut = prof_fut = confs_fut = None
+        if request.websafeConferenceKey:
+            conf_fut = ndb.Key(urlsafe=request.websafeConferenceKey).get_async()
+            # only the detail page needs the profile, for registration status
+            user = endpoints.get_current_user()
+            if user:
+                prof_fut = ndb.Key(Profile, getUserId(user)).get_async()
+        if request.includeConferences:
+            confs_fut = self._getQuery(request).fetch_async()
+        # usually served from instance memory while the RPCs above are in flight
+        bundle.announcement = HOT_CACHE.get(MEMCACHE_ANNOUNCEMENTS_KEY) or ""
+
+        if conf_fut:
+            conf = conf_fut.get_result()
+            if not conf:
+                raise endpoints.NotFoundException(
+                    'No conference found with key: %s' % request.websafeConferenceKey)
+            organizer = conf.key.parent().get_async()
+
+        if prof_fut:
+            prof = prof_fut.get_result() or self._getProfileFromUser()
+            bundle.profile = self._copyProfileToForm(prof)
+            bundle.isUserAttending = request.websafeConferenceKey in prof.conferenceKeysToAttend
+
+        if conf_fut:
+            bundle.conference = self._copyConferenceToForm(
+                conf, getattr(organizer.get_result(), 'displayName', None))
+        if confs_fut:
+            bundle.conferences = [self._copyConferenceToForm(item, "")
+                                  for item in confs_fut.get_result()]
+
+        return bundle
+
+# - - - Delta sync - - - - - - - - - - - - - - - - - - - -
+    def _changesPageAsync(self, model, prop, since, until, cursor, limit):
+        """Start fetching one page of model entities whose prop falls in (since, until]."""
+        if cursor == CHANGES_DONE:
+            return None
+        q = model.query(prop > since, prop <= until).order(prop)
+        return q.fetch_page_async(limit, start_cursor=Cursor(urlsafe=cursor) if cursor else None)
+
+    def _changesNextCursor(self, page):
+        items, next_cursor, more = page
+        return next_cursor.urlsafe() if more and next_cursor else CHANGES_DONE
+
+    @endpoints.method(CHANGES_GET_REQUEST, ChangesForm,
+                      path='changes',
+                      http_method='GET',
+                      name='getChangesSince')
+    def getChangesSince(self, request):
+        """Return conferences and sessions modified, and keys deleted, after `since`.
+
+        Keep calling with the returned until and cursors while `more` is true;
+        then use `until` as the next `since`. A `since` older than the
+        tombstone retention gets 410, and the client must resync from scratch.
+        """
+        try:
+            since = datetime.strptime(request.since, WATERMARK_FORMAT) if request.since \
+                else datetime.min
+            # pin the upper bound on the first page so later pages see a stable window
+            until = datetime.strptime(request.until, WATERMARK_FORMAT) if request.until \
+                else datetime.utcnow() - CHANGES_SAFETY_LAG
+        except ValueError:
+            raise endpoints.BadRequestException('Watermarks must look like %s' % WATERMARK_FORMAT)
+        if request.since and since < datetime.utcnow() - timedelta(days=TOMBSTONE_RETENTION_DAYS):
+            # deletes from back then may already have been purged
+            raise ChangesExpiredException('Watermark too old; resync without since.')
+        if request.limit is not None and request.limit <= 0:
+            raise endpoints.BadRequestException("'limit' must be positive.")
+        limit = min(request.limit or CHANGES_DEFAULT_LIMIT, CHANGES_MAX_LIMIT)
+
+        futures = [
+            self._changesPageAsync(Conference, Conference.modified, since, until, request.conferenceCursor, limit),
+            self._changesPageAsync(Session, Session.modified, since, until, request.sessionCursor, limit),
+            self._changesPageAsync(Tombstone, Tombstone.deleted, since, until, request.deletedCursor, limit),
+        ]
+        pages = [f.get_result() if f else ([], None, False) for f in futures]
+        conferences, sessions, tombstones = [page[0] for page in pages]
+        cursors = [self._changesNextCursor(page) for page in pages]
+
+        return ChangesForm(
+            conferences=[self._copyConferenceToForm(conf, "") for conf in conferences],
+            sessions=[self._copySessionToForm(session) for session in sessions],
+            deletedKeys=[tomb.websafeKey for tomb in tombstones],
+            until=until.strftime(WATERMARK_FORMAT),
+            conferenceCursor=cursors[0],
+            sessionCursor=cursors[1],
+            deletedCursor=cursors[2],
+            more=any(cursor != CHANGES_DONE for cursor in cursors),
+        )
+
 # registers API
 api = endpoints.api_server([ConferenceApi]) 
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+
+"""export.py
+
+NDJSON export of conferences, sessions and profiles (with registrations),
+used by the admin export handlers in main.py.
+
+Exports page through each kind with query cursors in fixed-size batches so
+memory stays flat. Large exports can be split into key-range shards that run
+as parallel task queue tasks, each writing its pages to Cloud Storage.
+"""
+
+import datetime
+import json
+
+from google.appengine.api import app_identity, urlfetch
+from google.appengine.ext import ndb
+from google.appengine.datastore.datastore_query import Cursor
+
+from models import Conference, Session, Profile
+
+EXPORT_KINDS = {
+    'Conference': Conference,
+    'Session': Session,
+    'Profile': Profile,
+}
+EXPORT_BATCH_SIZE = 200
+# sample this many scatter keys per shard to pick even shard boundaries
+SCATTER_OVERSAMPLE = 32
+GCS_SCOPE = 'https://www.googleapis.com/auth/devstorage.read_write'
+GCS_UPLOAD_URL = ('https://www.googleapis.com/upload/storage/v1/b/%s/o'
+                  '?uploadType=media&name=%s')
+
+
+def _jsonDefault(value):
+    """Serialize the datastore types json does not know about."""
+    if isinstance(value, (datetime.date, datetime.time, datetime.datetime)):
+        return value.isoformat()
+    if isinstance(value, ndb.Key):
+        return value.urlsafe()
+    raise TypeError('%r is not JSON serializable' % value)
+
+
+def toNdjsonLine(entity):
+    """Return entity as one line of newline-delimited JSON."""
+    data = entity.to_dict()
+    data['websafeKey'] = entity.key.urlsafe()
+    data['kind'] = entity.key.kind()
+    return json.dumps(data, default=_jsonDefault, sort_keys=True) + '\n'
+
+
+def _query(model, start_key=None, end_key=None):
+    """Key-ordered query over model, optionally limited to [start_key, end_key)."""
+    q = model.query()
+    if start_key:
+        q = q.filter(model._key >= start_key)
+    if end_key:
+        q = q.filter(model._key < end_key)
+    return q.order(model._key)
+
+
+def fetchBatch(model, cursor=None, start_key=None, end_key=None):
+    """Return (entities, next websafe cursor or None) for one export batch."""
+    entities, next_cursor, more = _query(model, start_key, end_key).fetch_page(
+        EXPORT_BATCH_SIZE, start_cursor=Cursor(urlsafe=cursor) if cursor else None)
+    return entities, next_cursor.urlsafe() if more and next_cursor else None
+
+
+def shardBoundaries(model, shards):
+    """Split model's key space into up to `shards` ranges using scatter keys.
+
+    Returns a list of (start_key, end_key) pairs; None means unbounded.
+    """
+    scatter_keys = model.query().order(ndb.GenericProperty('__scatter__')).fetch(
+        shards * SCATTER_OVERSAMPLE, keys_only=True)
+    scatter_keys.sort()
+    step = len(scatter_keys) / float(shards)
+    splits = sorted(set(scatter_keys[int(step * i)] for i in range(1, shards)
+                        if int(step * i) < len(scatter_keys)))
+    bounds = [None] + splits + [None]
+    return zip(bounds[:-1], bounds[1:])
+
+
+def writeToCloudStorage(object_name, body):
+    """Upload body to the app's default bucket with one authenticated request."""
+    token, _ = app_identity.get_access_token(GCS_SCOPE)
+    resp = urlfetch.fetch(
+        GCS_UPLOAD_URL % (app_identity.get_default_gcs_bucket_name(), object_name),
+        payload=body, method=urlfetch.POST, deadline=60,
+        headers={'Authorization': 'Bearer %s' % token,
+                 'Content-Type': 'application/x-ndjson'})
+    if resp.status_code != 200:
+        # raising makes the task queue retry the shard page
+        raise IOError('Cloud Storage upload of %s failed: %s'
+                      % (object_name, resp.status_code))
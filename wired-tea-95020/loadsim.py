@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+
+"""loadsim.py -- concurrent registration load simulator
+
+Drives ConferenceApi._conferenceRegistration from many simulated users at
+once against the local datastore testbed, using a high-replication
+consistency policy, and reports throughput, transaction retries and
+failures, p50/p99 latency, and whether any seats were oversold or lost
+(neither registered nor available any more).
+
+usage:
+    python loadsim.py --sdk /path/to/google_appengine --users 200 --seats 50
+
+"""
+
+import argparse
+import os
+import random
+import sys
+import threading
+import time
+
+
+def _setupSdk(sdk_path):
+    """Put the App Engine SDK and its bundled libraries on sys.path."""
+    sys.path.insert(0, sdk_path)
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+
+def _percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(pct / 100.0 * (len(values) - 1))))]
+
+
+def run(users, seats, threads, unregister_ratio, consistency):
+    """Run one simulation and return a dict of results."""
+    from google.appengine.datastore import datastore_stub_util
+    from google.appengine.ext import ndb, testbed
+    from conference import ConferenceApi
+    from models import Conference, ConflictException, Profile, TeeShirtSize
+
+    tb = testbed.Testbed()
+    tb.activate()
+    policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=consistency)
+    tb.init_datastore_v3_stub(consistency_policy=policy)
+    tb.init_memcache_stub()
+
+    local = threading.local()
+    stats = {'attempts': 0, 'ok': 0, 'rejected': 0, 'failed': 0}
+    latencies = []
+    lock = threading.Lock()
+
+    class SimulatedApi(ConferenceApi):
+        """ConferenceApi whose current user is chosen per simulated client thread."""
+        def _getProfileFromUser(self):
+            # called once per transaction attempt, so this also counts retries
+            with lock:
+                stats['attempts'] += 1
+            profile_key = ndb.Key(Profile, local.user_id)
+            return profile_key.get() or Profile(
+                key=profile_key,
+                displayName=local.user_id,
+                mainEmail=local.user_id,
+                teeShirtSize=str(TeeShirtSize.NOT_SPECIFIED),
+            )
+
+    class Request(object):
+        def __init__(self, websafeConferenceKey):
+            self.websafeConferenceKey = websafeConferenceKey
+
+    organizer = ndb.Key(Profile, 'organizer@example.com')
+    conf_key = Conference(parent=organizer, name='Load test', organizerUserId=organizer.id(),
+                          maxAttendees=seats, seatsAvailable=seats).put()
+    request = Request(conf_key.urlsafe())
+    api = SimulatedApi()
+    user_ids = ['user%d@example.com' % i for i in range(users)]
+    queue = list(user_ids)
+    random.shuffle(queue)
+
+    def call(reg):
+        start = time.time()
+        try:
+            api._conferenceRegistration(request, reg)
+            outcome = 'ok'
+        except ConflictException:
+            outcome = 'rejected'
+        except Exception:
+            # TransactionFailedError once ndb has given up retrying, among others
+            outcome = 'failed'
+        with lock:
+            stats[outcome] += 1
+            latencies.append(time.time() - start)
+        return outcome
+
+    def worker():
+        while True:
+            with lock:
+                if not queue:
+                    return
+                local.user_id = queue.pop()
+            if call(True) == 'ok' and random.random() < unregister_ratio:
+                call(False)
+
+    started = time.time()
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    elapsed = time.time() - started
+
+    # read back by key so the check does not depend on eventually consistent queries
+    conf = conf_key.get()
+    profiles = ndb.get_multi([ndb.Key(Profile, user_id) for user_id in user_ids])
+    registered = sum(1 for prof in profiles
+                     if prof and request.websafeConferenceKey in prof.conferenceKeysToAttend)
+    tb.deactivate()
+
+    calls = stats['ok'] + stats['rejected'] + stats['failed']
+    return {
+        'calls': calls,
+        'throughput': calls / elapsed if elapsed else 0.0,
+        'ok': stats['ok'],
+        'rejected': stats['rejected'],
+        'failed': stats['failed'],
+        'retries': stats['attempts'] - calls,
+        'p50_ms': _percentile(latencies, 50) * 1000,
+        'p99_ms': _percentile(latencies, 99) * 1000,
+        'registered': registered,
+        'seatsAvailable': conf.seatsAvailable,
+        # more seats handed out than exist
+        'oversold': registered > seats or conf.seatsAvailable < 0 or
+                    registered + conf.seatsAvailable > seats,
+        # seats taken from the counter without a matching registration
+        'lost': max(0, seats - registered - conf.seatsAvailable),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--sdk', default=os.environ.get('APPENGINE_SDK', ''),
+                        help='path to the App Engine SDK (or set APPENGINE_SDK)')
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--seats', type=int, default=50)
+    parser.add_argument('--threads', type=int, default=20)
+    parser.add_argument('--unregister-ratio', type=float, default=0.1,
+                        help='chance a registered user unregisters again')
+    parser.add_argument('--consistency', type=float, default=0.5,
+                        help='probability a write is immediately visible to queries')
+    args = parser.parse_args()
+
+    if args.sdk:
+        _setupSdk(args.sdk)
+    result = run(args.users, args.seats, args.threads, args.unregister_ratio, args.consistency)
+
+    print "calls:        %(calls)d (%(throughput).1f/s)" % result
+    print "succeeded:    %(ok)d, rejected: %(rejected)d, failed: %(failed)d" % result
+    print "txn retries:  %(retries)d" % result
+    print "latency:      p50 %(p50_ms).1fms, p99 %(p99_ms).1fms" % result
+    print "registered:   %(registered)d, seats left: %(seatsAvailable)d" % result
+    print "oversold:     %s" % ('YES' if result['oversold'] else 'no')
+    print "lost seats:   %(lost)d" % result
+    return 1 if result['oversold'] or result['lost'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
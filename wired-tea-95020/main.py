@@ -1,19 +1,56 @@
 #!/usr/bin/env python
 import webapp2
-from google.appengine.api import app_identity
-from google.appengine.api import mail
-from conference import ConferenceApi
+
+# Cron, task and admin handlers import what they need when they run, so an
+# instance started for API traffic does not pay for them.
+
+BACKFILL_BATCH_SIZE = 100
+# batches written per export response before handing back a resume cursor
+EXPORT_MAX_BATCHES = 50
+# upper bound on ?shards=, which is also the number of tasks enqueued at once
+EXPORT_MAX_SHARDS = 32
+TOMBSTONE_PURGE_BATCH_SIZE = 500
+
+
+class WarmupHandler(webapp2.RequestHandler):
+    def get(self):
+        """ Preload the API and prime the hot caches before the instance takes traffic. """
+        # importing conference builds the endpoints api_server
+        from conference import ConferenceApi
+        ConferenceApi._primeCaches()
 
 
 class SetAnnouncementHandler(webapp2.RequestHandler):
     def get(self):
         """Set Announcement in Memcache."""
+        from conference import ConferenceApi
         ConferenceApi._cacheAnnouncement()
 
 
+class PurgeTombstonesHandler(webapp2.RequestHandler):
+    def get(self):
+        """ Delete tombstones older than the retention period (cron). """
+        self.post()
+
+    def post(self):
+        """ Delete one batch of expired tombstones, then chain the next batch. """
+        from datetime import datetime, timedelta
+        from google.appengine.api import taskqueue
+        from google.appengine.ext import ndb
+        from models import Tombstone
+        from settings import TOMBSTONE_RETENTION_DAYS
+        cutoff = datetime.utcnow() - timedelta(days=TOMBSTONE_RETENTION_DAYS)
+        keys = Tombstone.query(Tombstone.deleted < cutoff).fetch(
+            TOMBSTONE_PURGE_BATCH_SIZE, keys_only=True)
+        ndb.delete_multi(keys)
+        if len(keys) == TOMBSTONE_PURGE_BATCH_SIZE:
+            taskqueue.add(url='/crons/purge_tombstones')
+
+
 class SendConfirmationEmailHandler(webapp2.RequestHandler):
     def post(self):
         """ Send email confirming Conference Creation. """
+        from google.appengine.api import app_identity, mail
         mail.send_mail(
             'noreply@%s.appspotmail.com' % (
                 app_identity.get_application_id()),
@@ -23,7 +60,146 @@ class SendConfirmationEmailHandler(webapp2.RequestHandler):
                 'conferenceInfo')
         )
 
+
+class BackfillUserIdentityHandler(webapp2.RequestHandler):
+    def get(self):
+        """Kick off the one-off UserIdentity backfill."""
+        from google.appengine.api import taskqueue
+        taskqueue.add(url='/tasks/backfill_user_identity')
+
+    def post(self):
+        """ Map one batch of Profile emails to their user ids, then chain the next batch. """
+        from google.appengine.api import taskqueue
+        from google.appengine.datastore.datastore_query import Cursor
+        from models import Profile
+        from utils import getOrCreateUserIdentity
+        cursor = Cursor(urlsafe=self.request.get('cursor') or None)
+        profiles, next_cursor, more = Profile.query().fetch_page(
+            BACKFILL_BATCH_SIZE, start_cursor=cursor)
+        for prof in profiles:
+            if prof.mainEmail:
+                # existing profiles keep their id; the first profile seen wins
+                getOrCreateUserIdentity(prof.mainEmail, prof.key.id())
+        if more and next_cursor:
+            taskqueue.add(url='/tasks/backfill_user_identity',
+                          params={'cursor': next_cursor.urlsafe()})
+
+
+class ExportHandler(webapp2.RequestHandler):
+    def get(self):
+        """ Export one kind as NDJSON, or fan it out into task queue shards.
+
+        ?kind=Conference|Session|Profile  kind to export
+        &cursor=...                       resume from the X-Export-Cursor of a previous response
+        &shards=N                         write N parallel shards to Cloud Storage instead
+        """
+        import json
+        import time
+        from google.appengine.api import taskqueue
+        from export import EXPORT_KINDS, toNdjsonLine, fetchBatch, shardBoundaries
+        kind = self.request.get('kind')
+        model = EXPORT_KINDS.get(kind)
+        if not model:
+            self.abort(400, 'kind must be one of: %s' % ', '.join(sorted(EXPORT_KINDS)))
+
+        try:
+            shards = int(self.request.get('shards') or 0)
+        except ValueError:
+            shards = -1
+        if not 0 <= shards <= EXPORT_MAX_SHARDS:
+            self.abort(400, 'shards must be an integer from 0 to %d' % EXPORT_MAX_SHARDS)
+        if shards:
+            export_id = '%s-%d' % (kind, time.time())
+            ranges = shardBoundaries(model, shards)
+            for shard, (start, end) in enumerate(ranges):
+                taskqueue.add(url='/tasks/export_shard', params={
+                    'kind': kind,
+                    'exportId': export_id,
+                    'shard': shard,
+                    'start': start.urlsafe() if start else '',
+                    'end': end.urlsafe() if end else '',
+                })
+            self.response.headers['Content-Type'] = 'application/json'
+            self.response.write(json.dumps({'exportId': export_id, 'shards': len(ranges)}))
+            return
+
+        self.response.headers['Content-Type'] = 'application/x-ndjson'
+        cursor = self.request.get('cursor') or None
+        for _ in range(EXPORT_MAX_BATCHES):
+            entities, cursor = fetchBatch(model, cursor)
+            self.response.write(''.join(toNdjsonLine(entity) for entity in entities))
+            if not cursor:
+                break
+        # an empty header means the export is complete
+        self.response.headers['X-Export-Cursor'] = cursor or ''
+
+
+class ExportShardHandler(webapp2.RequestHandler):
+    def post(self):
+        """ Write one batch of an export shard to Cloud Storage, then chain the next batch. """
+        from google.appengine.api import taskqueue
+        from google.appengine.ext import ndb
+        from export import EXPORT_KINDS, toNdjsonLine, fetchBatch, writeToCloudStorage
+        params = dict((name, self.request.get(name)) for name in
+                      ('kind', 'exportId', 'shard', 'start', 'end', 'cursor'))
+        page = int(self.request.get('page') or 0)
+        entities, next_cursor = fetchBatch(
+            EXPORT_KINDS[params['kind']],
+            cursor=params['cursor'] or None,
+            start_key=ndb.Key(urlsafe=params['start']) if params['start'] else None,
+            end_key=ndb.Key(urlsafe=params['end']) if params['end'] else None)
+        if entities:
+            # deterministic names keep task retries idempotent
+            writeToCloudStorage(
+                'exports/%s/%s-%03d-%05d.ndjson' % (params['exportId'], params['kind'],
+                                                    int(params['shard']), page),
+                ''.join(toNdjsonLine(entity) for entity in entities))
+        if next_cursor:
+            params.update(cursor=next_cursor, page=page + 1)
+            taskqueue.add(url='/tasks/export_shard', params=params)
+
+
+class MigrationHandler(webapp2.RequestHandler):
+    def get(self):
+        """ Start (or with &resume=1, resume) the mapper named by ?mapper=. """
+        from migrations import MAPPERS
+        mapper = MAPPERS.get(self.request.get('mapper'))
+        if not mapper:
+            self.abort(400, 'mapper must be one of: %s' % ', '.join(sorted(MAPPERS)))
+        if mapper().run(resume=bool(self.request.get('resume'))):
+            self.response.write('%s started' % mapper.name())
+        else:
+            self.response.write('%s not started; see its checkpoint' % mapper.name())
+
+
+class RateLimitStatsHandler(webapp2.RequestHandler):
+    def get(self):
+        """ Show accepted/shed counts for the rate-limited endpoints. """
+        import json
+        from ratelimit import stats
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(stats(), sort_keys=True))
+
+
+class CacheStatsHandler(webapp2.RequestHandler):
+    def get(self):
+        """ Show hit/miss counts for the two-tier caches. """
+        import json
+        from conference import HOT_CACHE
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(
+            dict((cache.namespace, cache.stats()) for cache in (HOT_CACHE,)), sort_keys=True))
+
+
 app = webapp2.WSGIApplication([
+    ('/_ah/warmup', WarmupHandler),
     ('/crons/set_announcement', SetAnnouncementHandler),
-    ('/tasks/send_confirmation_email', SendConfirmationEmailHandler)
+    ('/crons/purge_tombstones', PurgeTombstonesHandler),
+    ('/tasks/send_confirmation_email', SendConfirmationEmailHandler),
+    ('/tasks/backfill_user_identity', BackfillUserIdentityHandler),
+    ('/admin/export', ExportHandler),
+    ('/tasks/export_shard', ExportShardHandler),
+    ('/admin/migrate', MigrationHandler),
+    ('/admin/ratelimit_stats', RateLimitStatsHandler),
+    ('/admin/cache_stats', CacheStatsHandler)
     ], debug=True)
@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+
+"""mapper.py
+
+Generic batched, resumable mapper over a datastore kind.
+
+A Mapper walks a query with cursors, hands each entity to map() and writes
+the results back with put_multi/delete_multi one batch at a time. It chains
+itself through deferred task queue tasks, checkpointing its cursor after
+every batch, so long migrations and backfills never hit a request deadline
+and can be resumed after a failure.
+
+Subclass it, set KIND, implement map(), then call run():
+
+    class MyMapper(Mapper):
+        KIND = Conference
+
+        def map(self, conf):
+            conf.city = conf.city.strip()
+            return [conf], []
+
+    MyMapper().run()
+"""
+
+import logging
+import time
+import uuid
+
+from google.appengine.ext import deferred, ndb
+from google.appengine.datastore.datastore_query import Cursor
+
+
+class MapperCheckpoint(ndb.Model):
+    """MapperCheckpoint -- progress of a mapper run, keyed by mapper name"""
+    cursor = ndb.StringProperty(indexed=False)
+    # the task chain allowed to advance this checkpoint; older chains stop
+    runId = ndb.StringProperty(indexed=False)
+    processed = ndb.IntegerProperty(default=0, indexed=False)
+    written = ndb.IntegerProperty(default=0, indexed=False)
+    done = ndb.BooleanProperty(default=False)
+    modified = ndb.DateTimeProperty(auto_now=True)
+
+
+class Mapper(object):
+    """Base class for batched, resumable, self-chaining datastore mappers."""
+    # model class to map over
+    KIND = None
+    # entities fetched and written per batch
+    BATCH_SIZE = 100
+    # seconds to wait between batches, to throttle load on the datastore;
+    # 0 runs batches back to back until TASK_TIME_BUDGET is spent
+    THROTTLE_SECONDS = 1
+    # stop and chain a new task after this many seconds of work
+    TASK_TIME_BUDGET = 30
+    QUEUE = 'default'
+
+    def map(self, entity):
+        """Return (entities_to_put, keys_to_delete) for one entity."""
+        raise NotImplementedError()
+
+    def query(self):
+        """Query to map over; override to add filters."""
+        return self.KIND.query()
+
+    def finish(self):
+        """Called once after the last batch has been written."""
+        pass
+
+    @classmethod
+    def name(cls):
+        return cls.__name__
+
+    def checkpoint(self):
+        """Return the stored progress of this mapper, if it has ever run."""
+        # bypass the in-context cache so a resumed run's new runId is seen
+        return ndb.Key(MapperCheckpoint, self.name()).get(use_cache=False)
+
+    def run(self, resume=False):
+        """Start the mapper, or with resume pick up from the last checkpoint.
+
+        Returns False without starting anything if a run is unfinished and
+        resume is not set, so two chains never walk the same kind at once.
+        Resuming hands the checkpoint to a new chain; any older chain still
+        queued stops at its next batch.
+        """
+        def txn():
+            checkpoint = self.checkpoint()
+            if checkpoint and not checkpoint.done and not resume:
+                logging.warning('%s has an unfinished run; resume it instead', self.name())
+                return False
+            if checkpoint and checkpoint.done and resume:
+                logging.info('%s already finished', self.name())
+                return False
+            if not checkpoint or checkpoint.done:
+                checkpoint = MapperCheckpoint(id=self.name())
+            checkpoint.runId = uuid.uuid4().hex
+            checkpoint.put()
+            # enqueued only if the handoff commits
+            deferred.defer(self._continue, checkpoint.runId,
+                           _queue=self.QUEUE, _transactional=True)
+            return True
+        return ndb.transaction(txn)
+
+    def _advance(self, run_id, cursor, next_cursor, processed, written, chain):
+        """Record a finished batch; return the checkpoint, or None if superseded.
+
+        Runs in a transaction and only moves the checkpoint on from the cursor
+        the batch started at, so neither an older chain nor a duplicate task
+        of this one can overwrite newer progress.
+        """
+        checkpoint = self.checkpoint()
+        if (not checkpoint or checkpoint.runId != run_id or checkpoint.done or
+                checkpoint.cursor != cursor):
+            return None
+        checkpoint.cursor = next_cursor
+        checkpoint.processed += processed
+        checkpoint.written += written
+        checkpoint.done = next_cursor is None
+        checkpoint.put()
+        if chain and not checkpoint.done:
+            deferred.defer(self._continue, run_id, _queue=self.QUEUE,
+                           _countdown=self.THROTTLE_SECONDS, _transactional=True)
+        return checkpoint
+
+    def _continue(self, run_id):
+        """Process batches until the time budget runs out, then chain another task.
+
+        Each batch starts from the cursor stored in the checkpoint, so a
+        retried task resumes after the last checkpointed batch instead of
+        redoing the batches its failed attempt already finished. With
+        THROTTLE_SECONDS set, every batch runs in its own task, chained with
+        that countdown.
+        """
+        started = time.time()
+        while True:
+            checkpoint = self.checkpoint()
+            if not checkpoint or checkpoint.runId != run_id or checkpoint.done:
+                # superseded by a resumed run, or already finished
+                return
+
+            cursor = checkpoint.cursor
+            entities, next_cursor, more = self.query().fetch_page(
+                self.BATCH_SIZE, start_cursor=Cursor(urlsafe=cursor) if cursor else None)
+
+            to_put, to_delete = [], []
+            for entity in entities:
+                puts, deletes = self.map(entity)
+                to_put.extend(puts)
+                to_delete.extend(deletes)
+            if to_put:
+                ndb.put_multi(to_put)
+            if to_delete:
+                ndb.delete_multi(to_delete)
+
+            # a crash before this commits repeats only the current batch, so map() must be idempotent
+            chain = bool(self.THROTTLE_SECONDS) or time.time() - started >= self.TASK_TIME_BUDGET
+            checkpoint = ndb.transaction(lambda: self._advance(
+                run_id, cursor, next_cursor.urlsafe() if more and next_cursor else None,
+                len(entities), len(to_put) + len(to_delete), chain))
+            if not checkpoint:
+                return
+
+            if checkpoint.done:
+                logging.info('%s finished: %d processed, %d written',
+                             self.name(), checkpoint.processed, checkpoint.written)
+                self.finish()
+                return
+            if chain:
+                return
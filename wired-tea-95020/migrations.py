@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+
+"""migrations.py
+
+Schema migrations and backfills, run through the batched Mapper in mapper.py.
+Start one from /admin/migrate?mapper=<name>, adding &resume=1 to continue
+from its last checkpoint.
+"""
+
+import logging
+
+from mapper import Mapper
+from models import Conference, Session
+
+
+def _hasUnparsableDuration(session):
+    """True (and logged) if the session still holds a non-integer legacy duration."""
+    if isinstance(session.duration, basestring):
+        logging.warning('Session %s has unparsable duration %r; skipped',
+                        session.key.urlsafe(), session.duration)
+        return True
+    return False
+
+
+class SessionDurationMapper(Mapper):
+    """Rewrite Session.duration, once stored as a string, as integer minutes."""
+    KIND = Session
+
+    def map(self, session):
+        if _hasUnparsableDuration(session):
+            # leave it for a human rather than overwrite it
+            return [], []
+        # DurationProperty already parses legacy strings on load; putting the
+        # entity back stores the integer
+        return [session], []
+
+
+class ConferenceModifiedMapper(Mapper):
+    """Stamp Conference.modified on entities written before it existed."""
+    KIND = Conference
+
+    def map(self, conf):
+        # auto_now sets modified on put
+        return [conf], []
+
+
+class SessionModifiedMapper(Mapper):
+    """Stamp Session.modified on entities written before it existed."""
+    KIND = Session
+
+    def map(self, session):
+        # such a session cannot be put until its duration is fixed by hand
+        if _hasUnparsableDuration(session):
+            return [], []
+        return [session], []
+
+
+MAPPERS = dict((mapper.name(), mapper) for mapper in (
+    SessionDurationMapper,
+    ConferenceModifiedMapper,
+    SessionModifiedMapper,
+))
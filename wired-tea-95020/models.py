@@ -29,6 +29,12 @@ class Profile(ndb.Model):
     mainEmail = ndb.StringProperty()
     teeShirtSize = ndb.StringProperty(default='NOT_SPECIFIED')
     conferenceKeysToAttend = ndb.StringProperty(repeated=True)
+    wishlistKeys = ndb.StringProperty(repeated=True)
+
+
+class UserIdentity(ndb.Model):
+    """UserIdentity -- maps a user's email (the key name) to their user id"""
+    userId = ndb.StringProperty(required=True)
 
 
 class ProfileMiniForm(messages.Message):
@@ -64,6 +70,34 @@ class TeeShirtSize(messages.Enum):
     XXXL_W = 15
 
 
+class Tombstone(ndb.Model):
+    """Tombstone -- records a deleted Conference or Session for delta sync
+
+    Keyed as a child of the deleted key, so it shares the deleted entity's
+    group and a transactional delete can commit it atomically.
+    """
+    entityKind = ndb.StringProperty()
+    websafeKey = ndb.StringProperty(indexed=False)
+    deleted = ndb.DateTimeProperty(auto_now_add=True)
+
+    @classmethod
+    def _write(cls, key):
+        # a fixed id makes writing the same tombstone twice harmless
+        cls(key=ndb.Key(cls, 1, parent=key), entityKind=key.kind(), websafeKey=key.urlsafe()).put()
+
+    @classmethod
+    def recordInTransaction(cls, key):
+        """Pre-delete hook body: inside a transaction, commit the tombstone with the delete."""
+        if ndb.in_transaction():
+            cls._write(key)
+
+    @classmethod
+    def record(cls, key, future):
+        """Post-delete hook body: outside a transaction, leave a tombstone if the delete succeeded."""
+        if not ndb.in_transaction() and future.get_exception() is None:
+            cls._write(key)
+
+
 class Conference(ndb.Model):
     """ Conference -- Conference object """
     name = ndb.StringProperty(required=True)
@@ -76,6 +110,15 @@ class Conference(ndb.Model):
     endDate = ndb.DateProperty()
     maxAttendees = ndb.IntegerProperty()
     seatsAvailable = ndb.IntegerProperty()
+    modified = ndb.DateTimeProperty(auto_now=True)
+
+    @classmethod
+    def _pre_delete_hook(cls, key):
+        Tombstone.recordInTransaction(key)
+
+    @classmethod
+    def _post_delete_hook(cls, key, future):
+        Tombstone.record(key, future)
 
 
 class ConferenceForm(messages.Message):
@@ -99,6 +142,18 @@ class ConferenceForms(messages.Message):
     items = messages.MessageField(ConferenceForm, 1, repeated=True)
 
 
+class SeatAvailabilityForm(messages.Message):
+    """SeatAvailabilityForm -- live seat count outbound form message"""
+    websafeKey = messages.StringField(1)
+    seatsAvailable = messages.IntegerField(2)
+    maxAttendees = messages.IntegerField(3)
+
+
+class SeatAvailabilityForms(messages.Message):
+    """SeatAvailabilityForms -- multiple SeatAvailabilityForm outbound form message"""
+    items = messages.MessageField(SeatAvailabilityForm, 1, repeated=True)
+
+
 class ConferenceQueryForm(messages.Message):
     """ConferenceQueryForm -- Conference query inbound form message"""
     field = messages.StringField(1)
@@ -111,6 +166,15 @@ class ConferenceQueryForms(messages.Message):
     filters = messages.MessageField(ConferenceQueryForm, 1, repeated=True)
 
 
+class PageBundleForm(messages.Message):
+    """PageBundleForm -- everything a page needs to render, in one outbound message"""
+    profile = messages.MessageField(ProfileForm, 1)
+    conference = messages.MessageField(ConferenceForm, 2)
+    isUserAttending = messages.BooleanField(3)
+    conferences = messages.MessageField(ConferenceForm, 4, repeated=True)
+    announcement = messages.StringField(5)
+
+
 # needed for conference registration
 class BooleanMessage(messages.Message):
     """BooleanMessage-- outbound Boolean value message"""
@@ -122,20 +186,55 @@ class ConflictException(endpoints.ServiceException):
     http_status = httplib.CONFLICT
 
 
+class TooManyRequestsException(endpoints.ServiceException):
+    """TooManyRequestsException -- rate limit exceeded, mapped to HTTP 403 response
+    (Endpoints rewrites 429 to 404; Google APIs use 403 for rateLimitExceeded)"""
+    http_status = httplib.FORBIDDEN
+
+
+class ChangesExpiredException(endpoints.ServiceException):
+    """ChangesExpiredException -- watermark older than the tombstone retention,
+    mapped to HTTP 410 response; the client must resync from scratch"""
+    http_status = httplib.GONE
+
+
 class StringMessage(messages.Message):
     """StringMessage-- outbound (single) string message"""
     data = messages.StringField(1, required=True)
 
 
+class DurationProperty(ndb.IntegerProperty):
+    """Integer minutes; also reads the string values stored before the
+    migrations.SessionDurationMapper run. Strings that are not a plain
+    integer are returned as-is so the mapper can report them instead of
+    overwriting them."""
+    def _db_get_value(self, v, unused_p):
+        if v.has_stringvalue():
+            try:
+                return int(v.stringvalue())
+            except ValueError:
+                return v.stringvalue()
+        return super(DurationProperty, self)._db_get_value(v, unused_p)
+
+
 class Session(ndb.Model):
     """Sessions model to record the sessions of a conference"""
     name = ndb.StringProperty(required=True)
     highlights = ndb.StringProperty()
     speaker = ndb.StringProperty(required=True)
-    duration = ndb.StringProperty()
+    duration = DurationProperty()
     typeOfSession = ndb.StringProperty(required=True)
     date = ndb.DateProperty()
     startTime = ndb.TimeProperty()
+    modified = ndb.DateTimeProperty(auto_now=True)
+
+    @classmethod
+    def _pre_delete_hook(cls, key):
+        Tombstone.recordInTransaction(key)
+
+    @classmethod
+    def _post_delete_hook(cls, key, future):
+        Tombstone.record(key, future)
 
 
 class SessionForm(messages.Message):
@@ -147,8 +246,21 @@ class SessionForm(messages.Message):
     typeOfSession = messages.StringField(5)
     date = messages.StringField(6)
     startTime = messages.StringField(7)
+    websafeKey = messages.StringField(8)
 
 
 class SessionForms(messages.Message):
     """ Multiple Session outbound form message """
     items = messages.MessageField(SessionForm, 1, repeated=True)
+
+
+class ChangesForm(messages.Message):
+    """ChangesForm -- conferences, sessions and deletions changed since a watermark"""
+    conferences = messages.MessageField(ConferenceForm, 1, repeated=True)
+    sessions = messages.MessageField(SessionForm, 2, repeated=True)
+    deletedKeys = messages.StringField(3, repeated=True)
+    until = messages.StringField(4)
+    conferenceCursor = messages.StringField(5)
+    sessionCursor = messages.StringField(6)
+    deletedCursor = messages.StringField(7)
+    more = messages.BooleanField(8)
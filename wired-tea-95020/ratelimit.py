@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+
+"""ratelimit.py
+
+Admission control for expensive endpoints: a memcache-backed token bucket
+per (user, endpoint), with per-endpoint cost weights from settings.py.
+Calls over budget are shed with a 403 that says when to retry, and
+accepted/shed counts are kept per instance and flushed to memcache
+periodically for the stats handler.
+"""
+
+import functools
+import math
+import time
+
+import endpoints
+from google.appengine.api import memcache
+
+from cache import FlushedCounters
+from models import TooManyRequestsException
+from settings import RATE_LIMIT_CAPACITY, RATE_LIMIT_REFILL_PER_SECOND, RATE_LIMIT_COSTS
+from utils import getUserId
+
+MEMCACHE_BUCKET_PREFIX = "RATELIMIT_BUCKET_"
+MEMCACHE_STATS_PREFIX = "RATELIMIT_STATS_"
+# give up on a contended bucket after this many compare-and-set attempts
+CAS_RETRIES = 3
+# an idle bucket is full again after this long, so memcache may drop it
+BUCKET_TTL = int(math.ceil(RATE_LIMIT_CAPACITY / RATE_LIMIT_REFILL_PER_SECOND)) + 1
+
+
+def _clientId(service):
+    """Who to charge: the signed-in user, otherwise the caller's address."""
+    user = endpoints.get_current_user()
+    if user:
+        return getUserId(user)
+    # the API frontend proxies every call, so REMOTE_ADDR is not the caller
+    request_state = getattr(service, 'request_state', None)
+    return 'anonymous:%s' % getattr(request_state, 'remote_address', '')
+
+
+# counted in instance memory so accepted calls cost no extra memcache RPC
+_counters = FlushedCounters(MEMCACHE_STATS_PREFIX)
+
+
+def _count(endpoint, outcome):
+    _counters.incr('%s:%s' % (endpoint, outcome))
+
+
+def consume(key, cost):
+    """Spend cost tokens from the bucket at key; return 0 or the seconds to wait."""
+    client = memcache.Client()
+    for _ in range(CAS_RETRIES):
+        now = time.time()
+        state = client.gets(key)
+        if state is None:
+            if cost > RATE_LIMIT_CAPACITY:
+                return int(math.ceil(cost / RATE_LIMIT_REFILL_PER_SECOND))
+            if client.add(key, (RATE_LIMIT_CAPACITY - cost, now), time=BUCKET_TTL):
+                return 0
+            continue
+        tokens, last = state
+        tokens = min(RATE_LIMIT_CAPACITY, tokens + (now - last) * RATE_LIMIT_REFILL_PER_SECOND)
+        if tokens < cost:
+            return int(math.ceil((cost - tokens) / RATE_LIMIT_REFILL_PER_SECOND))
+        if client.cas(key, (tokens - cost, now), time=BUCKET_TTL):
+            return 0
+    # memcache is contended or unavailable; fail open rather than reject everyone
+    return 0
+
+
+def rateLimited(endpoint, when=None):
+    """Decorate an API method so each call spends RATE_LIMIT_COSTS[endpoint] tokens.
+
+    With when, only calls whose request satisfies when(request) are charged.
+    """
+    cost = RATE_LIMIT_COSTS.get(endpoint, 1)
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(self, request):
+            if when and not when(request):
+                return func(self, request)
+            retry_after = consume('%s%s:%s' % (MEMCACHE_BUCKET_PREFIX, endpoint, _clientId(self)), cost)
+            if retry_after:
+                _count(endpoint, 'shed')
+                raise TooManyRequestsException(
+                    'Too many requests to %s; retry after %d seconds.' % (endpoint, retry_after))
+            _count(endpoint, 'accepted')
+            return func(self, request)
+        return wrapper
+    return decorator
+
+
+def stats():
+    """Accepted/shed counts per rate-limited endpoint, as of each instance's last flush."""
+    counts = _counters.totals(['%s:%s' % (endpoint, outcome)
+                               for endpoint in RATE_LIMIT_COSTS for outcome in ('accepted', 'shed')])
+    return dict((endpoint, {'accepted': counts['%s:accepted' % endpoint],
+                            'shed': counts['%s:shed' % endpoint]})
+                for endpoint in RATE_LIMIT_COSTS)
@@ -14,3 +14,30 @@ created/forked from conference.py by wesc on 2014 may 24
 # Console or Cloud Console.
 WEB_CLIENT_ID = '205992183565-tm5aclaj883gis0umiiu8j6qusiugokn.apps.googleusercontent.com'
 
+
+# Token verification endpoints used by utils.getUserId(id_type="oauth").
+# Point TOKENINFO_URL at a local stub to exercise the oauth path offline.
+TOKENINFO_URL = 'https://www.googleapis.com/oauth2/v1/tokeninfo'
+GOOGLE_CERTS_URL = 'https://www.googleapis.com/oauth2/v3/certs'
+
+# Verify id_tokens against Google's cached signing keys instead of calling
+# tokeninfo on every request; tokeninfo is still used as the fallback.
+VERIFY_ID_TOKENS_LOCALLY = False
+
+# Per-user token bucket in front of expensive endpoints (see ratelimit.py).
+# Every user gets RATE_LIMIT_CAPACITY tokens, refilled at
+# RATE_LIMIT_REFILL_PER_SECOND; each call spends its endpoint's cost.
+RATE_LIMIT_CAPACITY = 30
+RATE_LIMIT_REFILL_PER_SECOND = 1.0
+RATE_LIMIT_COSTS = {
+    'queryConferences': 3,
+    'getPageBundle': 3,
+    'getConferenceSessionsBySpeaker': 5,
+    'getSessionsInWishlist': 2,
+    'getSessionsInWishlistByType': 5,
+    'getSessionsInWishlistBySpeaker': 5,
+}
+
+# Tombstones of deleted conferences and sessions are purged after this many
+# days; getChangesSince rejects older watermarks, since their deletes are gone.
+TOMBSTONE_RETENTION_DAYS = 30
@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+
+"""startup_bench.py -- cold-start cost of the app's entry points
+
+Imports each WSGI entry point in a fresh interpreter, the way a new instance
+loads it, and reports the median and worst import time over several runs.
+
+usage:
+    python startup_bench.py --sdk /path/to/google_appengine --runs 10
+
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+
+# module: what a new instance loads to serve it
+ENTRY_POINTS = [
+    ('main', 'cron, task, admin and warmup handlers'),
+    ('conference', 'endpoints API, including api_server construction'),
+]
+
+_CHILD = '''
+import sys, time
+sys.path[0:0] = [%(sdk)r]
+import dev_appserver
+dev_appserver.fix_sys_path()
+sys.path.insert(0, %(app)r)
+start = time.time()
+import %(module)s
+sys.stdout.write('%%f' %% (time.time() - start))
+'''
+
+
+def timeImport(sdk, module):
+    """Seconds taken to import module in a new interpreter."""
+    app_dir = os.path.dirname(os.path.abspath(__file__))
+    out = subprocess.check_output(
+        [sys.executable, '-c', _CHILD % {'sdk': sdk, 'app': app_dir, 'module': module}])
+    return float(out.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--sdk', default=os.environ.get('APPENGINE_SDK', ''),
+                        help='path to the App Engine SDK (or set APPENGINE_SDK)')
+    parser.add_argument('--runs', type=int, default=10)
+    args = parser.parse_args()
+    if not args.sdk:
+        parser.error('--sdk or APPENGINE_SDK is required')
+
+    for module, description in ENTRY_POINTS:
+        times = sorted(timeImport(args.sdk, module) for _ in range(args.runs))
+        print "%-12s median %7.1fms  max %7.1fms  (%s)" % (
+            module, times[len(times) / 2] * 1000, times[-1] * 1000, description)
+
+
+if __name__ == '__main__':
+    main()
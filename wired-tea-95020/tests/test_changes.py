@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+
+"""test_changes.py -- getChangesSince delta-sync feed
+
+Runs against the App Engine testbed; put the SDK on the path with
+APPENGINE_SDK and run from the app directory:
+
+    APPENGINE_SDK=/path/to/google_appengine python -m unittest discover -s tests
+"""
+
+import os
+import sys
+import unittest
+from datetime import datetime, timedelta
+
+if os.environ.get('APPENGINE_SDK'):
+    sys.path.insert(0, os.environ['APPENGINE_SDK'])
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import endpoints
+from google.appengine.datastore import datastore_stub_util
+from google.appengine.ext import ndb, testbed
+
+from conference import ConferenceApi, CHANGES_GET_REQUEST, WATERMARK_FORMAT
+from models import Conference, Session, Tombstone, ChangesExpiredException
+
+
+class GetChangesSinceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=1)
+        self.testbed.init_datastore_v3_stub(consistency_policy=policy)
+        self.testbed.init_memcache_stub()
+        ndb.get_context().clear_cache()
+        self.api = ConferenceApi()
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def changes(self, **fields):
+        request = CHANGES_GET_REQUEST.combined_message_class(**fields)
+        return self.api.getChangesSince(request)
+
+    def until(self):
+        # past the safety lag, so entities put just now fall in the window
+        return (datetime.utcnow() + timedelta(minutes=1)).strftime(WATERMARK_FORMAT)
+
+    def testSessionRoundTrip(self):
+        conf_key = Conference(name='PyCon', seatsAvailable=10, maxAttendees=10).put()
+        session_key = Session(parent=conf_key, name='Keynote', speaker='Guido',
+                              typeOfSession='keynote', duration=45).put()
+
+        changes = self.changes(until=self.until())
+
+        self.assertEqual([c.websafeKey for c in changes.conferences], [conf_key.urlsafe()])
+        self.assertEqual(len(changes.sessions), 1)
+        session = changes.sessions[0]
+        self.assertEqual(session.websafeKey, session_key.urlsafe())
+        self.assertEqual(session.name, 'Keynote')
+        self.assertEqual(session.duration, 45)
+        self.assertFalse(changes.more)
+
+    def testDeletedSessionMatchesWebsafeKey(self):
+        conf_key = Conference(name='PyCon').put()
+        session_key = Session(parent=conf_key, name='Keynote', speaker='Guido',
+                              typeOfSession='keynote').put()
+        session_key.delete()
+
+        changes = self.changes(until=self.until())
+
+        self.assertEqual(changes.sessions, [])
+        self.assertEqual(changes.deletedKeys, [session_key.urlsafe()])
+
+    def testTransactionalDeleteCommitsItsTombstone(self):
+        conf_key = Conference(name='PyCon').put()
+        session_key = Session(parent=conf_key, name='Keynote', speaker='Guido',
+                              typeOfSession='keynote').put()
+        ndb.transaction(session_key.delete)
+
+        self.assertEqual(Tombstone.query(ancestor=session_key).count(), 1)
+        self.assertEqual(self.changes(until=self.until()).deletedKeys, [session_key.urlsafe()])
+
+    def testRejectsWatermarkOlderThanRetention(self):
+        since = (datetime.utcnow() - timedelta(days=365)).strftime(WATERMARK_FORMAT)
+        self.assertRaises(ChangesExpiredException, self.changes, since=since)
+
+    def testDefaultUntilLagsBehindRecentWrites(self):
+        conf_key = Conference(name='PyCon').put()
+        Session(parent=conf_key, name='Keynote', speaker='Guido', typeOfSession='keynote').put()
+
+        changes = self.changes()
+
+        self.assertEqual(changes.sessions, [])
+        self.assertLess(datetime.strptime(changes.until, WATERMARK_FORMAT), datetime.utcnow())
+
+    def testRejectsNonPositiveLimit(self):
+        self.assertRaises(endpoints.BadRequestException, self.changes, limit=-1)
+        self.assertRaises(endpoints.BadRequestException, self.changes, limit=0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+
+"""test_oauth.py -- token verification and caching in utils.getUserId
+
+urlfetch is replaced by a local stub standing in for Google's tokeninfo and
+certs endpoints. Run from the app directory:
+
+    APPENGINE_SDK=/path/to/google_appengine python -m unittest discover -s tests
+"""
+
+import base64
+import json
+import os
+import sys
+import time
+import unittest
+
+if os.environ.get('APPENGINE_SDK'):
+    sys.path.insert(0, os.environ['APPENGINE_SDK'])
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Crypto.Hash import SHA256
+from Crypto.PublicKey import RSA
+from Crypto.Signature import PKCS1_v1_5
+from google.appengine.api import urlfetch
+from google.appengine.ext import testbed
+
+import utils
+from settings import WEB_CLIENT_ID, TOKENINFO_URL, GOOGLE_CERTS_URL
+
+
+def _b64(raw):
+    return base64.urlsafe_b64encode(raw).rstrip('=')
+
+
+def _b64int(value):
+    digits = '%x' % value
+    return _b64(('0' * (len(digits) % 2) + digits).decode('hex'))
+
+
+class FakeResponse(object):
+    def __init__(self, status_code, content, headers=None):
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers or {}
+
+
+class StubUrlfetch(object):
+    """Answers urlfetch.fetch from a {url prefix: response or exception} table."""
+
+    def __init__(self):
+        self.routes = {}
+        self.calls = []
+
+    def fetch(self, url, **kwargs):
+        self.calls.append(url)
+        for prefix, response in self.routes.items():
+            if url.startswith(prefix):
+                if isinstance(response, Exception):
+                    raise response
+                return response
+        return FakeResponse(404, 'not found')
+
+    def count(self, prefix):
+        return len([url for url in self.calls if url.startswith(prefix)])
+
+
+class OAuthUserIdTest(unittest.TestCase):
+
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_memcache_stub()
+        utils._token_cache.clear()
+        utils._certs_cache.clear()
+        self.stub = StubUrlfetch()
+        self.real_fetch = urlfetch.fetch
+        urlfetch.fetch = self.stub.fetch
+        self.verify_locally = utils.VERIFY_ID_TOKENS_LOCALLY
+
+    def tearDown(self):
+        urlfetch.fetch = self.real_fetch
+        utils.VERIFY_ID_TOKENS_LOCALLY = self.verify_locally
+        self.testbed.deactivate()
+
+    def tokeninfo(self, user_id='1234', expires_in=3600):
+        self.stub.routes[TOKENINFO_URL] = FakeResponse(
+            200, json.dumps({'user_id': user_id, 'expires_in': expires_in}))
+
+    def signedToken(self, key, kid='k1', **claims):
+        payload = {'iss': 'accounts.google.com', 'aud': WEB_CLIENT_ID,
+                   'sub': '5678', 'exp': int(time.time()) + 600}
+        payload.update(claims)
+        signing_input = '%s.%s' % (_b64(json.dumps({'alg': 'RS256', 'kid': kid})),
+                                   _b64(json.dumps(payload)))
+        signature = PKCS1_v1_5.new(key).sign(SHA256.new(signing_input))
+        return '%s.%s' % (signing_input, _b64(signature))
+
+    def serveCerts(self, key, kid='k1'):
+        self.stub.routes[GOOGLE_CERTS_URL] = FakeResponse(
+            200, json.dumps({'keys': [{'kid': kid, 'n': _b64int(key.n), 'e': _b64int(key.e)}]}),
+            {'cache-control': 'public, max-age=600'})
+
+    def testTokeninfoResultIsCachedInBothTiers(self):
+        self.tokeninfo()
+        self.assertEqual(utils._getOAuthUserId('access_token', 'tok'), '1234')
+        self.assertEqual(utils._getOAuthUserId('access_token', 'tok'), '1234')
+        self.assertEqual(self.stub.count(TOKENINFO_URL), 1)
+
+        # a fresh instance still finds the result in memcache
+        utils._token_cache.clear()
+        self.assertEqual(utils._getOAuthUserId('access_token', 'tok'), '1234')
+        self.assertEqual(self.stub.count(TOKENINFO_URL), 1)
+
+    def testFailedVerificationIsNotCached(self):
+        self.stub.routes[TOKENINFO_URL] = FakeResponse(500, 'backend error')
+        self.assertEqual(utils._getOAuthUserId('access_token', 'tok'), '')
+        self.assertEqual(self.stub.count(TOKENINFO_URL), 2)
+        self.tokeninfo()
+        self.assertEqual(utils._getOAuthUserId('access_token', 'tok'), '1234')
+
+    def testIdTokenVerifiedLocallyWithoutTokeninfo(self):
+        utils.VERIFY_ID_TOKENS_LOCALLY = True
+        key = RSA.generate(1024)
+        self.serveCerts(key)
+        self.tokeninfo()
+
+        self.assertEqual(utils._getOAuthUserId('id_token', self.signedToken(key)), '5678')
+        self.assertEqual(self.stub.count(TOKENINFO_URL), 0)
+        # the signing keys are cached too
+        self.assertEqual(utils._getOAuthUserId('id_token', self.signedToken(key, sub='9')), '9')
+        self.assertEqual(self.stub.count(GOOGLE_CERTS_URL), 1)
+
+    def testBadSignatureFallsBackToTokeninfo(self):
+        utils.VERIFY_ID_TOKENS_LOCALLY = True
+        self.serveCerts(RSA.generate(1024))
+        self.tokeninfo()
+
+        token = self.signedToken(RSA.generate(1024))
+        self.assertEqual(utils._verifyIdToken(token), (None, None))
+        self.assertEqual(utils._getOAuthUserId('id_token', token), '1234')
+
+    def testWrongAudienceIsRejected(self):
+        key = RSA.generate(1024)
+        self.serveCerts(key)
+        self.assertEqual(utils._verifyIdToken(self.signedToken(key, aud='someone-else')),
+                         (None, None))
+
+    def testCertsFetchErrorFallsBackToTokeninfo(self):
+        utils.VERIFY_ID_TOKENS_LOCALLY = True
+        self.stub.routes[GOOGLE_CERTS_URL] = urlfetch.DownloadError('unreachable')
+        self.tokeninfo()
+
+        token = self.signedToken(RSA.generate(1024))
+        self.assertEqual(utils._getOAuthUserId('id_token', token), '1234')
+
+    def testNonObjectHeaderIsRejected(self):
+        token = '%s.%s.%s' % (_b64('[]'), _b64('{}'), _b64('sig'))
+        self.assertEqual(utils._verifyIdToken(token), (None, None))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+
+"""test_ratelimit.py -- token buckets and flushed counters
+
+Runs against the App Engine testbed memcache with a fake clock; put the SDK
+on the path with APPENGINE_SDK and run from the app directory:
+
+    APPENGINE_SDK=/path/to/google_appengine python -m unittest discover -s tests
+"""
+
+import os
+import sys
+import time
+import unittest
+
+if os.environ.get('APPENGINE_SDK'):
+    sys.path.insert(0, os.environ['APPENGINE_SDK'])
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from google.appengine.api import memcache
+from google.appengine.ext import testbed
+
+from cache import FlushedCounters
+from ratelimit import consume
+from settings import RATE_LIMIT_CAPACITY, RATE_LIMIT_REFILL_PER_SECOND
+
+BUCKET = 'RATELIMIT_BUCKET_test:user'
+
+
+class FakeClockTest(unittest.TestCase):
+
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_memcache_stub()
+        self.real_time = time.time
+        self.now = self.real_time()
+        time.time = lambda: self.now
+
+    def tearDown(self):
+        time.time = self.real_time
+        self.testbed.deactivate()
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+class ConsumeTest(FakeClockTest):
+
+    def testShedsWithRetryAfterOnceEmpty(self):
+        for _ in range(RATE_LIMIT_CAPACITY):
+            self.assertEqual(consume(BUCKET, 1), 0)
+        retry_after = consume(BUCKET, 5)
+        self.assertEqual(retry_after, int(5 / RATE_LIMIT_REFILL_PER_SECOND))
+        self.assertGreater(retry_after, 0)
+
+    def testRefillsOverTime(self):
+        self.assertEqual(consume(BUCKET, RATE_LIMIT_CAPACITY), 0)
+        self.assertGreater(consume(BUCKET, 4), 0)
+
+        self.advance(4 / RATE_LIMIT_REFILL_PER_SECOND)
+        self.assertEqual(consume(BUCKET, 4), 0)
+        self.assertGreater(consume(BUCKET, 1), 0)
+
+        # never refills past capacity
+        self.advance(10 * RATE_LIMIT_CAPACITY / RATE_LIMIT_REFILL_PER_SECOND)
+        self.assertEqual(consume(BUCKET, RATE_LIMIT_CAPACITY), 0)
+        self.assertGreater(consume(BUCKET, 1), 0)
+
+    def testCostAboveCapacityIsShed(self):
+        self.assertGreater(consume(BUCKET, RATE_LIMIT_CAPACITY + 1), 0)
+
+    def testFailsOpenWhenCompareAndSetKeepsFailing(self):
+        self.assertEqual(consume(BUCKET, RATE_LIMIT_CAPACITY), 0)
+        real_cas = memcache.Client.cas
+        memcache.Client.cas = lambda *args, **kwargs: False
+        try:
+            self.advance(1 / RATE_LIMIT_REFILL_PER_SECOND)
+            self.assertEqual(consume(BUCKET, 1), 0)
+        finally:
+            memcache.Client.cas = real_cas
+
+
+class FlushedCountersTest(FakeClockTest):
+
+    def testTotalsAfterFlush(self):
+        counters = FlushedCounters('TEST_STATS_', flush_interval=30)
+        counters.incr('accepted')
+        counters.incr('accepted')
+        counters.incr('shed')
+        self.assertEqual(counters.totals(['accepted', 'shed']), {'accepted': 0, 'shed': 0})
+
+        counters.flush()
+        self.assertEqual(counters.totals(['accepted', 'shed']), {'accepted': 2, 'shed': 1})
+
+    def testInstancesFlushIntoSharedTotals(self):
+        first = FlushedCounters('TEST_STATS_', flush_interval=30)
+        second = FlushedCounters('TEST_STATS_', flush_interval=30)
+        first.incr('accepted', 3)
+        first.flush()
+
+        second.incr('accepted')
+        self.assertEqual(second.totals(['accepted']), {'accepted': 3})
+        # the next count after the interval flushes without an explicit call
+        self.advance(30)
+        second.incr('accepted')
+        self.assertEqual(second.totals(['accepted']), {'accepted': 5})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,10 +1,182 @@
+import base64
+import hashlib
 import json
 import os
 import time
 import uuid
 
-from google.appengine.api import urlfetch
-from models import Profile
+import endpoints
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+from cache import LRUCache
+from models import UserIdentity
+from settings import WEB_CLIENT_ID, TOKENINFO_URL, GOOGLE_CERTS_URL, VERIFY_ID_TOKENS_LOCALLY
+
+MEMCACHE_TOKEN_PREFIX = "TOKEN_USER_ID_"
+MEMCACHE_CERTS_KEY = "GOOGLE_SIGNING_KEYS"
+TOKEN_CACHE_SIZE = 1000
+# never trust a verified token for longer than this, whatever its expiry says
+TOKEN_CACHE_MAX_TTL = 3600
+CERTS_DEFAULT_TTL = 3600
+MEMCACHE_IDENTITY_PREFIX = "USER_IDENTITY_"
+IDENTITY_CACHE_SIZE = 1000
+# an email's user id never changes once assigned, so it can be cached for long
+IDENTITY_CACHE_TTL = 24 * 3600
+ID_TOKEN_ISSUERS = ('accounts.google.com', 'https://accounts.google.com')
+
+
+# per-instance caches, shared by every request thread on this instance
+_token_cache = LRUCache(TOKEN_CACHE_SIZE)
+_certs_cache = LRUCache(1)
+_identity_cache = LRUCache(IDENTITY_CACHE_SIZE)
+
+
+def _b64decode(segment):
+    """Decode an unpadded base64url JWT segment."""
+    segment = str(segment)
+    return base64.urlsafe_b64decode(segment + '=' * (-len(segment) % 4))
+
+
+def _getSigningKeys():
+    """Return Google's id_token signing keys as {kid: (n, e)}, cached per max-age."""
+    # imported here so instances that never verify a token skip loading urlfetch
+    from google.appengine.api import urlfetch
+    keys = _certs_cache.get(MEMCACHE_CERTS_KEY)
+    if keys is not None:
+        return keys
+    cached = memcache.get(MEMCACHE_CERTS_KEY)
+    if cached is not None:
+        keys, expires_at = cached
+        _certs_cache.set(MEMCACHE_CERTS_KEY, keys, expires_at)
+        return keys
+
+    try:
+        resp = urlfetch.fetch(GOOGLE_CERTS_URL)
+    except urlfetch.Error:
+        # DownloadError, DeadlineExceededError...; the caller falls back to tokeninfo
+        return {}
+    if resp.status_code != 200:
+        return {}
+    keys = {}
+    for jwk in json.loads(resp.content).get('keys', []):
+        keys[jwk['kid']] = (long(_b64decode(jwk['n']).encode('hex'), 16),
+                            long(_b64decode(jwk['e']).encode('hex'), 16))
+
+    ttl = CERTS_DEFAULT_TTL
+    for directive in resp.headers.get('cache-control', '').split(','):
+        name, _, value = directive.strip().partition('=')
+        if name == 'max-age' and value.isdigit():
+            ttl = int(value)
+    expires_at = time.time() + ttl
+    _certs_cache.set(MEMCACHE_CERTS_KEY, keys, expires_at)
+    memcache.set(MEMCACHE_CERTS_KEY, (keys, expires_at), time=ttl)
+    return keys
+
+
+def _verifyIdToken(token):
+    """Verify an id_token locally; return (user_id, expires_at) or (None, None)."""
+    from Crypto.Hash import SHA256
+    from Crypto.PublicKey import RSA
+    from Crypto.Signature import PKCS1_v1_5
+
+    try:
+        header_seg, payload_seg, signature_seg = str(token).split('.')
+        header = json.loads(_b64decode(header_seg))
+        payload = json.loads(_b64decode(payload_seg))
+        signature = _b64decode(signature_seg)
+    except (ValueError, TypeError):
+        return None, None
+    if not isinstance(header, dict) or not isinstance(payload, dict):
+        return None, None
+
+    key = _getSigningKeys().get(header.get('kid'))
+    if header.get('alg') != 'RS256' or not key:
+        return None, None
+    verifier = PKCS1_v1_5.new(RSA.construct(key))
+    if not verifier.verify(SHA256.new('%s.%s' % (header_seg, payload_seg)), signature):
+        return None, None
+
+    if payload.get('iss') not in ID_TOKEN_ISSUERS:
+        return None, None
+    if payload.get('aud') not in (WEB_CLIENT_ID, endpoints.API_EXPLORER_CLIENT_ID):
+        return None, None
+    expires_at = payload.get('exp', 0)
+    if expires_at <= time.time() or not payload.get('sub'):
+        return None, None
+    return payload['sub'], expires_at
+
+
+def _fetchTokenInfo(token_type, token):
+    """Ask tokeninfo about the token; return (user_id, expires_at) or (None, None)."""
+    from google.appengine.api import urlfetch
+    for attempt in range(2):
+        resp = urlfetch.fetch('%s?%s=%s' % (TOKENINFO_URL, token_type, token))
+        if resp.status_code == 200:
+            info = json.loads(resp.content)
+            expires_in = int(info.get('expires_in', TOKEN_CACHE_MAX_TTL))
+            return info.get('user_id'), time.time() + expires_in
+        elif resp.status_code == 400 and 'invalid_token' in resp.content:
+            token_type = 'access_token'
+        # other failures are retried once straight away; sleeping only ties up the request thread
+    return None, None
+
+
+def _getOAuthUserId(token_type, token):
+    """Resolve a bearer token to a user id through the instance, memcache and network tiers."""
+    cache_key = MEMCACHE_TOKEN_PREFIX + hashlib.sha256(token).hexdigest()
+    user_id = _token_cache.get(cache_key)
+    if user_id is not None:
+        return user_id
+    cached = memcache.get(cache_key)
+    if cached is not None:
+        user_id, expires_at = cached
+        _token_cache.set(cache_key, user_id, expires_at)
+        return user_id
+
+    user_id, expires_at = None, None
+    if token_type == 'id_token' and VERIFY_ID_TOKENS_LOCALLY:
+        user_id, expires_at = _verifyIdToken(token)
+    if not user_id:
+        user_id, expires_at = _fetchTokenInfo(token_type, token)
+    if not user_id:
+        return ''
+
+    # bound the cache lifetime by the token's own expiry
+    expires_at = min(expires_at, time.time() + TOKEN_CACHE_MAX_TTL)
+    ttl = int(expires_at - time.time())
+    if ttl > 0:
+        _token_cache.set(cache_key, user_id, expires_at)
+        memcache.set(cache_key, (user_id, expires_at), time=ttl)
+    return user_id
+
+
+@ndb.transactional
+def getOrCreateUserIdentity(email, user_id=None):
+    """Return the user id mapped to email, assigning user_id (or a new uuid) if unmapped."""
+    identity_key = ndb.Key(UserIdentity, email)
+    identity = identity_key.get()
+    if not identity:
+        identity = UserIdentity(key=identity_key,
+                                userId=user_id or str(uuid.uuid1().get_hex()))
+        identity.put()
+    return identity.userId
+
+
+def _getCustomUserId(email):
+    """Resolve email to a user id through the instance, memcache and datastore tiers."""
+    cache_key = MEMCACHE_IDENTITY_PREFIX + email
+    user_id = _identity_cache.get(cache_key)
+    if user_id is not None:
+        return user_id
+    user_id = memcache.get(cache_key)
+    if user_id is None:
+        # the common case is an existing mapping, which needs no transaction
+        identity = ndb.Key(UserIdentity, email).get()
+        user_id = identity.userId if identity else getOrCreateUserIdentity(email)
+        memcache.set(cache_key, user_id, time=IDENTITY_CACHE_TTL)
+    _identity_cache.set(cache_key, user_id, time.time() + IDENTITY_CACHE_TTL)
+    return user_id
+
 
 def getUserId(user, id_type="email"):
     if id_type == "email":
@@ -17,29 +189,9 @@ def getUserId(user, id_type="email"):
         token_type = 'id_token'
         if 'OAUTH_USER_ID' in os.environ:
             token_type = 'access_token'
-        url = ('https://www.googleapis.com/oauth2/v1/tokeninfo?%s=%s'
-               % (token_type, token))
-        user = {}
-        wait = 1
-        for i in range(3):
-            resp = urlfetch.fetch(url)
-            if resp.status_code == 200:
-                user = json.loads(resp.content)
-                break
-            elif resp.status_code == 400 and 'invalid_token' in resp.content:
-                url = ('https://www.googleapis.com/oauth2/v1/tokeninfo?%s=%s'
-                       % ('access_token', token))
-            else:
-                time.sleep(wait)
-                wait = wait + i
-        return user.get('user_id', '')
+        return _getOAuthUserId(token_type, token)
 
     if id_type == "custom":
-        # implement your own user_id creation and getting algorythm
-        # this is just a sample that queries datastore for an existing profile
-        # and generates an id if profile does not exist for an email
-        profile = Conference.query(Conference.mainEmail == user.email())
-        if profile:
-            return profile.id()
-        else:
-            return str(uuid.uuid1().get_hex())
+        # a single key get on the email -> user id mapping; a new id is
+        # only generated the first time an email is seen
+        return _getCustomUserId(user.email())